@@ -1,20 +1,31 @@
 #!/usr/bin/env python3
 """Run the gear: set up for and call command-line command."""
 
+import csv
+import fnmatch
+import itertools
 import json
+import logging
 import os
+import shlex
+import shutil
+import subprocess
 import sys
+import tempfile
 import zipfile
-from pathlib import Path
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache, partial
+from pathlib import Path, PurePosixPath
 
 import flywheel_gear_toolkit
-import pandas as pd
 from flywheel_gear_toolkit.interfaces.command_line import exec_command
 from flywheel_gear_toolkit.licenses.freesurfer import install_freesurfer_license
-from flywheel_gear_toolkit.utils.zip_tools import unzip_archive, zip_output
+from flywheel_gear_toolkit.utils.zip_tools import unzip_archive
 
-from utils.fly.despace import despace
+from utils.fly.despace import despace_name
 from utils.fly.make_file_name_safe import make_file_name_safe
+from utils.fly.prefetch import prefetch
+from utils.fly.zip_output import zip_output
 
 GEAR = "freesurfer-recon-all"
 REPO = "flywheel-apps"
@@ -28,6 +39,169 @@ SUBJECTS_DIR = Path("/usr/local/freesurfer/subjects")
 FREESURFER_HOME = "/usr/local/freesurfer"
 LICENSE_FILE = FREESURFER_HOME + "/license.txt"
 
+# Optional inputs that provide more anatomical images
+ADDITIONAL_T1_INPUTS = [
+    "t1w_anatomical_2",
+    "t1w_anatomical_3",
+    "t1w_anatomical_4",
+    "t1w_anatomical_5",
+]
+T2_INPUT = "t2w_anatomical"
+
+# Input directories with scans, these have spaces removed from file names
+INPUT_DIRS = ["anatomical"] + ADDITIONAL_T1_INPUTS + [T2_INPUT]
+
+# Segmentation volumes that hold label numbers (all less than 32768)
+LABEL_VOLUMES = {
+    "aparc+aseg.mgz",
+    "aparc.a2009s+aseg.mgz",
+    "aseg.mgz",
+    "lh.hippoAmygLabels-T1.v21.FSvoxelSpace.mgz",
+    "rh.hippoAmygLabels-T1.v21.FSvoxelSpace.mgz",
+    "brainstemSsLabels.v12.FSvoxelSpace.mgz",
+    "gtmseg.mgz",
+    "ThalamicNuclei.v12.T1.mgz",
+    "ThalamicNuclei.v12.T1.FSvoxelSpace.mgz",
+}
+
+# Runs the commands given to exec_commands(), the surface conversions and the
+# input scan.  Nothing run here waits on this executor so it cannot deadlock.
+# main() sizes it to the number of cpus the gear was told to use.
+COMMAND_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+
+@lru_cache(maxsize=None)
+def find_program(program, path):
+    """Find the full path to a program once instead of on every run.
+
+    Args:
+        program (str): name of the program
+        path (str): the PATH to search
+
+    Returns:
+        program (str): full path to program or its name if it was not found
+    """
+
+    return shutil.which(program, path=path) or program
+
+
+def set_command_workers(n_workers):
+    """Size the shared COMMAND_EXECUTOR to the number of cpus to use.
+
+    Args:
+        n_workers (int): maximum number of commands to run at once, usually
+            config["openmp"] as set by set_core_count()
+    """
+
+    global COMMAND_EXECUTOR
+
+    COMMAND_EXECUTOR.shutdown()
+    COMMAND_EXECUTOR = ThreadPoolExecutor(max_workers=max(int(n_workers), 1))
+
+
+def exec_commands(commands, environ, dry_run, log, max_workers=None):
+    """Run independent commands concurrently.
+
+    Each command is run with exec_command() in a thread from the shared
+    COMMAND_EXECUTOR so that the single threaded commands started by
+    post-processing stages that run at the same time don't add up to more than
+    the number of cpus the gear was told to use.  All commands are allowed to
+    finish before any failure is reported.
+
+    Args:
+        commands (list of list of str): the command lines to be run
+        environ (dict): shell environment saved in Dockerfile
+        dry_run (boolean): actually do it or do everything but
+        log (GearToolkitContext.log): logger set up by Gear Toolkit
+        max_workers (int): maximum number of these commands to run at once
+            (default is no limit other than the size of COMMAND_EXECUTOR)
+
+    Raises:
+        RuntimeError: the first failure (in the order given) if any command fails
+    """
+
+    if not max_workers:
+        max_workers = len(commands)
+
+    path = (environ or os.environ).get("PATH")
+    commands = [[find_program(cmd[0], path)] + cmd[1:] for cmd in commands]
+
+    futures = []
+    running = set()
+    for cmd in commands:
+        if len(running) >= max_workers:
+            _, running = wait(running, return_when=FIRST_COMPLETED)
+        future = COMMAND_EXECUTOR.submit(
+            exec_command, cmd, environ=environ, dry_run=dry_run, cont_output=True,
+        )
+        futures.append(future)
+        running.add(future)
+    wait(futures)
+
+    failures = []
+    for future in futures:
+        exc = future.exception()
+        if exc:
+            log.error(exc)
+            failures.append(exc)
+
+    if failures:
+        raise failures[0]
+
+
+def run_stages(stages, log, max_workers=1, completed=None):
+    """Run stages concurrently as soon as the stages they depend on are done.
+
+    Stages are started in the order given, so with max_workers=1 they run one
+    after the other in that order.  A stage is not run if a stage it depends on
+    fails.  Dependencies that are not in stages are ignored.
+
+    Args:
+        stages (dict): (function, list of names of stages it depends on) keyed
+            by the stage name.  The function is called with no arguments.
+        log (GearToolkitContext.log): logger set up by Gear Toolkit
+        max_workers (int): maximum number of stages to run at once
+        completed (set): the names of stages that finish are added to this
+
+    Raises:
+        the first failure if any stage fails
+    """
+
+    if completed is None:
+        completed = set()
+
+    pending = dict(stages)
+    running = {}  # future: stage name
+    failures = []
+
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        while pending or running:
+            for name, (function, depends_on) in list(pending.items()):
+                if len(running) >= max_workers:
+                    break
+                if all(dd in completed or dd not in stages for dd in depends_on):
+                    running[executor.submit(function)] = name
+                    del pending[name]
+
+            if not running:  # what is left depends on stages that failed
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                exc = future.exception()
+                if exc:
+                    log.error("%s failed: %s", name, exc)
+                    failures.append(exc)
+                else:
+                    completed.add(name)
+
+    for name in pending:
+        log.warning("%s was not run because a stage before it failed", name)
+
+    if failures:
+        raise failures[0]
+
 
 def set_core_count(config, log):
     """get # cpu's to set -openmp by setting config["openmp"]
@@ -37,11 +211,12 @@ def set_core_count(config, log):
         log (GearToolkitContext.log): logger set up by Gear Toolkit
     """
 
-    os_cpu_count = os.cpu_count()
+    os_cpu_count = os.cpu_count() or 1  # None if it cannot be determined
     log.info("os.cpu_count() = %d", os_cpu_count)
     n_cpus = config.get("n_cpus")
     if n_cpus:
         del config["n_cpus"]
+        n_cpus = int(n_cpus)
         if n_cpus > os_cpu_count:
             log.warning("n_cpus > number available, using max %d", os_cpu_count)
             config["openmp"] = os_cpu_count
@@ -53,11 +228,131 @@ def set_core_count(config, log):
         log.info("using n_cpus = %d (maximum available)", os_cpu_count)
 
 
-def check_for_previous_run(log):
+def set_thread_placement(command, environ, config, log):
+    """Keep recon-all's threads and memory close to the cores that use them.
+
+    OpenMP threads are bound to cores so they keep their caches warm.  This is
+    only done when recon-all runs a single process: with -parallel, both
+    hemispheres would bind their threads to the same first cores.  On machines
+    with more than one NUMA node, memory is interleaved across the nodes with
+    numactl (if it is installed).
+
+    Args:
+        command (list of str): the recon-all command line
+        environ (dict): shell environment saved in Dockerfile
+        config (GearToolkitContext.config): config dictionary from config.json
+        log (GearToolkitContext.log): logger set up by Gear Toolkit
+
+    Returns:
+        command (list of str), environ (dict): copies to use for recon-all
+    """
+
+    environ = dict(environ)
+    if not config.get("parallel"):
+        environ.setdefault("OMP_PROC_BIND", "close")
+        environ.setdefault("OMP_PLACES", "cores")
+        log.debug("Binding OpenMP threads to cores")
+
+    numa_nodes = list(Path("/sys/devices/system/node").glob("node[0-9]*"))
+    if len(numa_nodes) > 1 and shutil.which("numactl"):
+        log.info("Interleaving memory across %d NUMA nodes", len(numa_nodes))
+        # numactl goes after "time" which is a shell keyword
+        command = command[:1] + ["numactl", "--interleave=all"] + command[1:]
+
+    return command, environ
+
+
+def thread_environ(environ, n_threads):
+    """Copy the environment, limiting the number of threads commands use.
+
+    Args:
+        environ (dict): shell environment saved in Dockerfile
+        n_threads (int): number of OpenMP and ITK threads to use
+
+    Returns:
+        environ (dict): a copy of the environment with the thread count set
+    """
+
+    environ = dict(environ)
+    environ["OMP_NUM_THREADS"] = str(n_threads)
+    environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(n_threads)
+
+    return environ
+
+
+def member_path(dest, name):
+    """Get where a member of a zip file is extracted to.
+
+    Args:
+        dest (Path): directory to extract into
+        name (str): the member's name in the zip file
+
+    Returns:
+        path (Path): the member's path inside of dest
+
+    Raises:
+        ValueError: if the name is absolute or has ".." in it so the member
+            would be outside of dest
+    """
+
+    parts = PurePosixPath(name).parts
+    if not parts or PurePosixPath(name).is_absolute() or ".." in parts:
+        raise ValueError(f"'{name}' is not inside of the zip file's directory")
+
+    return Path(dest).joinpath(*parts)
+
+
+def extract_members(archive, members, dest, max_workers=1):
+    """Extract members of a zip file using several threads.
+
+    Each thread opens the archive itself because a ZipFile cannot be shared.
+    Directories are made first so the threads do not race to make them.
+    Every name is checked before anything is written.
+
+    Args:
+        archive (Path): the zip file
+        members (list of zipfile.ZipInfo): what to extract
+        dest (Path): directory to extract into
+        max_workers (int): number of threads
+
+    Raises:
+        ValueError: if a member would be extracted outside of dest
+    """
+
+    targets = [(member, member_path(dest, member.filename)) for member in members]
+
+    files = []
+    for member, target in targets:
+        if member.is_dir():
+            target.mkdir(parents=True, exist_ok=True)
+        else:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            files.append((member, target))
+
+    def extract_chunk(chunk):
+        with open(archive, "rb", buffering=1024 * 1024) as raw:
+            with zipfile.ZipFile(raw) as zipit:
+                for member, target in chunk:
+                    with zipit.open(member) as src, open(target, "wb") as dst:
+                        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+    n_chunks = max(min(max_workers, len(files)), 1)
+    # every n_chunks'th file so large and small files are spread evenly
+    chunks = [files[ii::n_chunks] for ii in range(n_chunks)]
+    if n_chunks == 1:
+        extract_chunk(chunks[0])
+    else:
+        with ThreadPoolExecutor(max_workers=n_chunks) as executor:
+            list(executor.map(extract_chunk, chunks))
+
+
+def check_for_previous_run(inputs, log, max_workers=1):
     """Check for .zip file that contains subject from a previous run.
 
     Args:
+        inputs (dict): files in each input directory as found by scan_inputs()
         log (GearToolkitContext.log): logger set up by Gear Toolkit
+        max_workers (int): number of threads to use to extract the subject
 
     Returns:
         new_subject_id (str)
@@ -65,25 +360,51 @@ def check_for_previous_run(log):
 
     new_subject_id = ""  # assume not going to find zip file
 
-    anat_dir = INPUT_DIR / "anatomical"
-    find = list(anat_dir.rglob("freesurfer-recon-all*.zip"))
+    find = [
+        f
+        for f in inputs.get("anatomical", [])
+        if fnmatch.fnmatch(f.name, "freesurfer-recon-all*.zip")
+    ]
     if len(find) > 0:
         if len(find) > 1:
             log.warning("Found %d previous freesurfer runs. Using first", len(find))
         fs_archive = find[0]
-        unzip_archive(str(fs_archive), SUBJECTS_DIR)
-        try:
-            zipit = zipfile.ZipFile(fs_archive)
-            new_subject_id = zipit.namelist()[0].split("/")[0]
+        # Use a large buffer: the default 8 KiB makes reading a big subject
+        # directory slow on network storage
+        with open(fs_archive, "rb", buffering=1024 * 1024) as raw:
+            with zipfile.ZipFile(raw) as zipit:
+                members = zipit.infolist()
+        if members:
+            new_subject_id = members[0].filename.split("/", 1)[0]
             log.debug("new_subject_id %s", new_subject_id)
-        except:
-            new_subject_id = ""
+        # The subject directory is extracted under its own name so it can
+        # only be used if that name is already safe
+        if members and (
+            not new_subject_id or make_file_name_safe(new_subject_id) != new_subject_id
+        ):
+            log.critical("No SUBJECT DIR could be found! Cannot continue. Exiting")
+            sys.exit(1)
+        # Only the subject directory is needed.  Anything else would be
+        # extracted over the other subjects (e.g. fsaverage).
+        subject_members = [
+            m for m in members if m.filename.split("/", 1)[0] == new_subject_id
+        ]
+        if len(subject_members) < len(members):
+            log.warning(
+                "Ignoring %d files outside of %s/ in %s",
+                len(members) - len(subject_members),
+                new_subject_id,
+                fs_archive.name,
+            )
+        # A subject directory has thousands of files so decompress and write
+        # them on several cores
+        try:
+            extract_members(fs_archive, subject_members, SUBJECTS_DIR, max_workers)
+        except ValueError as exc:
+            log.critical("%s in %s. Exiting", exc, fs_archive.name)
+            sys.exit(1)
 
         if new_subject_id != "":
-            new_subject_id = make_file_name_safe(new_subject_id)
-            if not Path(SUBJECTS_DIR / new_subject_id).exists():
-                log.critical("No SUBJECT DIR could be found! Cannot continue. Exiting")
-                sys.exit(1)
             log.info(
                 "recon-all running from previous run...(recon-all -subjid %s)",
                 new_subject_id,
@@ -92,12 +413,45 @@ def check_for_previous_run(log):
     return new_subject_id
 
 
-def get_input_file(log):
+def scan_inputs(root, despace_dirs=()):
+    """Find all regular files in a directory tree with a single walk.
+
+    Hidden files are ignored and hidden directories are not searched.  Spaces
+    in names are replaced with underscores (like despace()) in the given top
+    level directories as they are scanned.
+
+    Args:
+        root (Path): the top of the directory tree
+        despace_dirs (list of str): top level directories to remove spaces from
+
+    Returns:
+        found (dict): lists of files (Path) keyed by the name of the top level
+            directory they are in ("" for files directly in root)
+    """
+
+    found = {}
+    for dirpath, dirs, files in os.walk(root):
+        rel_path = os.path.relpath(dirpath, root)
+        top = "" if rel_path == "." else rel_path.split(os.sep, 1)[0]
+        if top in despace_dirs:
+            # renaming dirs in place makes os.walk() descend into the new names
+            dirs[:] = [despace_name(dirpath, dd) for dd in dirs]
+            files = [despace_name(dirpath, ff) for ff in files]
+        dirs[:] = [dd for dd in dirs if not dd.startswith(".")]
+        for ff in files:
+            if not ff.startswith("."):
+                found.setdefault(top, []).append(Path(dirpath) / ff)
+
+    return found
+
+
+def get_input_file(inputs, log):
     """Provide required anatomical file as input to the gear.
 
     Input file can be either a NIfTI file or a DICOM archive.
 
     Args:
+        inputs (dict): files in each input directory as found by scan_inputs()
         log (GearToolkitContext.log): logger set up by Gear Toolkit
 
     Returns:
@@ -105,9 +459,8 @@ def get_input_file(log):
     """
 
     anat_dir = INPUT_DIR / "anatomical"
-    despace(anat_dir)
 
-    anatomical_list = list(anat_dir.rglob("*.nii*"))
+    anatomical_list = [f for f in inputs.get("anatomical", []) if ".nii" in f.name]
     if len(anatomical_list) == 1:
         anatomical = str(anatomical_list[0])
 
@@ -116,15 +469,15 @@ def get_input_file(log):
         # find all regular files that are not hidden and are not in a hidden
         # directory.  Like this bash command:
         # ANATOMICAL=$(find $INPUT_DIR/* -not -path '*/\.*' -type f | head -1)
-        anatomical_list = [
-            f for f in INPUT_DIR.rglob("[!.]*") if "/." not in str(f) and f.is_file()
-        ]
+        anatomical_list = [f for files in inputs.values() for f in files]
 
         if len(anatomical_list) == 0:
             log.critical(
                 "Anatomical input could not be found in %s! Exiting (1)", str(anat_dir),
             )
-            os.system(f"ls -lRa {str(anat_dir)}")
+            # only hidden files could be there, but don't flood the log
+            for dirpath, dirs, files in itertools.islice(os.walk(anat_dir), 100):
+                log.info("%s: %s", dirpath, " ".join(sorted(dirs + files)[:100]))
             sys.exit(1)
 
         anatomical = str(anatomical_list[0])
@@ -132,12 +485,7 @@ def get_input_file(log):
             dicom_dir = anat_dir / "dicoms"
             dicom_dir.mkdir()
             unzip_archive(anatomical, dicom_dir)
-            despace(dicom_dir)
-            anatomical_list = [
-                f
-                for f in dicom_dir.rglob("[!.]*")
-                if "/." not in str(f) and f.is_file()
-            ]
+            anatomical_list = scan_inputs(anat_dir, ["dicoms"]).get("dicoms", [])
             anatomical = str(anatomical_list[0])
 
     else:
@@ -149,54 +497,46 @@ def get_input_file(log):
     return anatomical
 
 
-def get_additional_inputs(log):
+def get_additional_inputs(inputs, log):
     """Process additional anatomical inputs.
 
     Additional T1 and T2 input files must all be NIfTI (.nii or .nii.gz)
 
     Args:
+        inputs (dict): files in each input directory as found by scan_inputs()
         log (GearToolkitContext.log): logger set up by Gear Toolkit
 
     Returns:
-        add_inputs (str): arguments to pass in for additional input files
+        add_inputs (list of str): arguments to pass in for additional input files
     """
 
-    add_inputs = ""
+    add_inputs = []
 
     # additional T1 input files
-    anat_dir_2 = INPUT_DIR / "t1w_anatomical_2"
-    anat_dir_3 = INPUT_DIR / "t1w_anatomical_3"
-    anat_dir_4 = INPUT_DIR / "t1w_anatomical_4"
-    anat_dir_5 = INPUT_DIR / "t1w_anatomical_5"
-    for anat_dir in (anat_dir_2, anat_dir_3, anat_dir_4, anat_dir_5):
-        if anat_dir.is_dir():
-            despace(anat_dir)
-            anatomical_list = [f for f in anat_dir.rglob("*.nii*") if f.is_file()]
-            if len(anatomical_list) > 0:
-                log.info("Adding %s to the processing stream...", anatomical_list[0])
-                add_inputs += f"-i {str(anatomical_list[0])} "
-
-    # T2 input file
-    t2_dir = INPUT_DIR / "t2w_anatomical"
-    if t2_dir.is_dir():
-        despace(t2_dir)
-        anatomical_list = [f for f in t2_dir.rglob("*.nii*") if f.is_file()]
+    for input_name in ADDITIONAL_T1_INPUTS:
+        anatomical_list = [f for f in inputs.get(input_name, []) if ".nii" in f.name]
         if len(anatomical_list) > 0:
-            log.info("Adding T2 %s to the processing stream...", anatomical_list[0])
-            add_inputs += f"-T2 {str(anatomical_list[0])} "
+            log.info("Adding %s to the processing stream...", anatomical_list[0])
+            add_inputs += ["-i", str(anatomical_list[0])]
 
-    add_inputs = add_inputs.rstrip()  # so split below won't add extra empty string
+    # T2 input file
+    anatomical_list = [f for f in inputs.get(T2_INPUT, []) if ".nii" in f.name]
+    if len(anatomical_list) > 0:
+        log.info("Adding T2 %s to the processing stream...", anatomical_list[0])
+        add_inputs += ["-T2", str(anatomical_list[0])]
 
     return add_inputs
 
 
-def generate_command(subject_id, command_config, log):
+def generate_command(subject_id, command_config, log, inputs=None):
     """Compose the shell command to run recon-all.
 
     Args:
         subject_id (str): Freesurfer subject directory name
         command_config (dict): configuration parameters and values to pass in
         log (GearToolkitContext.log): logger set up by Gear Toolkit
+        inputs (dict): files in each input directory as found by scan_inputs()
+            (the input directory is scanned if this is not given)
 
     Returns:
         command (list of str): the command line to be run
@@ -208,19 +548,31 @@ def generate_command(subject_id, command_config, log):
     # 1) re-running a previous run (if .zip file is provided)
     # 2) by providing anatomical files as input to the gear
 
-    new_subject_id = check_for_previous_run(log)
+    if inputs is None:
+        inputs = scan_inputs(INPUT_DIR, INPUT_DIRS)
+
+    new_subject_id = check_for_previous_run(
+        inputs, log, max_workers=int(command_config.get("openmp", 1))
+    )
     if new_subject_id:
         subject_id = new_subject_id
         command.append("-subjid")
         command.append(subject_id)
 
     else:
-        anatomical = get_input_file(log)
+        anatomical = get_input_file(inputs, log)
         command.append("-i")
         command.append(anatomical)
-        add_inputs = get_additional_inputs(log)
-        if add_inputs:
-            command += add_inputs.split(" ")
+        add_inputs = get_additional_inputs(inputs, log)
+        command += add_inputs
+        # Start reading the images while recon-all gets going.  A DICOM series
+        # is read in its entirety so get all of it.
+        if ".nii" in anatomical:
+            input_files = [anatomical]
+        else:
+            input_files = [e.path for e in os.scandir(Path(anatomical).parent)]
+        input_files += add_inputs[1::2]
+        prefetch(input_files)
         command.append("-subjid")
         command.append(subject_id)
 
@@ -228,7 +580,7 @@ def generate_command(subject_id, command_config, log):
     for key, val in command_config.items():
         # print(f"key:{key} val:{val} type:{type(val)}")
         if key == "reconall_options":
-            command += val.split(" ")
+            command += val.split()  # any amount of white space separates options
         elif isinstance(val, bool):
             if val:
                 command.append(f"-{key}")
@@ -253,18 +605,150 @@ def remove_i_args(command):
 
     resume_command = []
 
-    skip_arg = False
-    for arg in command:
+    args = iter(command)
+    for arg in args:
         if arg == "-i":
-            skip_arg = True  # and don't append
-        elif skip_arg:
-            skip_arg = False  # it is hereby skipped
+            next(args, None)  # skip the path that follows it too
         else:
             resume_command.append(arg)
 
     return resume_command
 
 
+def spaces_to_csv(txt_file, csv_file, dry_run):
+    """Convert a space separated table from FreeSurfer into a .csv file.
+
+    This is done in Python rather than running "tr" in a shell.  The rows are
+    returned so the table does not have to be read back from the .csv file.
+
+    Args:
+        txt_file (str): the space separated table
+        csv_file (str): the .csv file to write
+        dry_run (boolean): actually do it or do everything but
+
+    Returns:
+        rows (list of list of str): the table or None if it was not converted
+    """
+
+    if dry_run or not Path(txt_file).exists():
+        return None
+
+    rows = [line.split() for line in Path(txt_file).read_text().splitlines()]
+    rows = [row for row in rows if row]
+    Path(csv_file).write_text("".join(",".join(row) + "\n" for row in rows))
+
+    return rows
+
+
+def load_table(txt_file, csv_file, dry_run):
+    """Convert a table to .csv or read the .csv file if it was made earlier.
+
+    Args:
+        txt_file (str): the space separated table
+        csv_file (str): the .csv file to write
+        dry_run (boolean): actually do it or do everything but
+
+    Returns:
+        rows (list of list of str): the table or None if there is none
+    """
+
+    rows = spaces_to_csv(txt_file, csv_file, dry_run)
+
+    if rows is None and Path(csv_file).exists():
+        rows = read_csv_rows(csv_file)
+
+    return rows
+
+
+def read_csv_rows(csv_file):
+    """Read all rows of a .csv file.
+
+    Args:
+        csv_file (str): the table
+
+    Returns:
+        rows (list of list of str): the non-empty rows
+    """
+
+    with open(csv_file, newline="") as csv_in:
+        return [row for row in csv.reader(csv_in) if row]
+
+
+def to_number(text):
+    """Convert a value from a stats table to an int or float if it is a number.
+
+    Counts such as NumVert stay integers, as they were when pandas read them.
+
+    Args:
+        text (str): a cell from a .csv file
+
+    Returns:
+        value (int, float or str): the number or the original text if it is not one
+    """
+
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def two_column_to_dict(rows):
+    """Make a dictionary from a table of structure names and their measures.
+
+    Args:
+        rows (list of list of str): one structure name and its measure per row
+
+    Returns:
+        stats_json (dict): measure for each structure
+    """
+
+    return {row[0]: to_number(row[1]) for row in rows}
+
+
+def one_row_to_dict(rows):
+    """Make a dictionary from a table with a header and one row of measures.
+
+    The first column (the subject) is left out.
+
+    Args:
+        rows (list of list of str): the header and the measures
+
+    Returns:
+        stats_json (dict): measure for each column in the header
+    """
+
+    header, values = rows[0], rows[1]
+
+    return {key: to_number(value) for key, value in zip(header[1:], values[1:])}
+
+
+def is_up_to_date(output_file, source_file, log):
+    """Check if a file made from another one is newer than it.
+
+    Args:
+        output_file (Path): the file that was made
+        source_file (Path): the file it was made from
+        log (GearToolkitContext.log): logger set up by Gear Toolkit
+
+    Returns:
+        up_to_date (boolean): output_file does not need to be made again
+    """
+
+    if not (output_file.exists() and source_file.exists()):
+        return False
+
+    if output_file.stat().st_mtime < source_file.stat().st_mtime:
+        return False
+
+    log.info("%s is up to date", output_file.name)
+
+    return True
+
+
 def do_gear_hippocampal_subfields(subject_id, mri_dir, dry_run, environ, metadata, log):
     """Run segmentHA_T1.sh and convert results to .csv files
 
@@ -291,27 +775,12 @@ def do_gear_hippocampal_subfields(subject_id, mri_dir, dry_run, environ, metadat
     ]
     for tf in txt_files:
         tablefile = f"{OUTPUT_DIR}/{subject_id}_{tf.replace('.txt','.csv')}"
-        cmd = [
-            "tr",
-            "' '",
-            ",",
-            "<",
-            f"{mri_dir}/{tf}",
-            ">",
-            tablefile,
-        ]
-        exec_command(
-            cmd, environ=environ, shell=True, dry_run=dry_run, cont_output=True
-        )
+        rows = load_table(f"{mri_dir}/{tf}", tablefile, dry_run)
 
         # add those stats to metadata on the destination analysis container
-        if Path(tablefile).exists():
+        if rows:
             log.info("%s exists.  Adding to metadata.", tablefile)
-            stats_df = pd.read_csv(tablefile, names=["struc", "measure"])
-            dft = stats_df.transpose()
-            dft.columns = dft.iloc[0]
-            dft = dft[1:]
-            stats_json = dft.drop(dft.columns[0], axis=1).to_dict("records")[0]
+            stats_json = two_column_to_dict(rows)
             metadata["analysis"]["info"][f"{tf.replace('.txt','')}"] = stats_json
         else:
             log.info("%s is missing", tablefile)
@@ -341,21 +810,11 @@ def do_gear_brainstem_structures(subject_id, mri_dir, dry_run, environ, metadata
         f"{mri_dir}/brainstemSsVolumes.v2.txt",
     ]
     exec_command(cmd, environ=environ, dry_run=dry_run, cont_output=True)
-    cmd = [
-        "tr",
-        "' '",
-        ",",
-        "<",
-        f"{mri_dir}/brainstemSsVolumes.v2.txt",
-        ">",
-        tablefile,
-    ]
-    exec_command(cmd, environ=environ, shell=True, dry_run=dry_run, cont_output=True)
+    rows = load_table(f"{mri_dir}/brainstemSsVolumes.v2.txt", tablefile, dry_run)
 
     # add those stats to metadata on the destination analysis container
-    if Path(tablefile).exists():
-        stats_df = pd.read_csv(tablefile)
-        stats_json = stats_df.drop(stats_df.columns[0], axis=1).to_dict("records")[0]
+    if rows:
+        stats_json = one_row_to_dict(rows)
         metadata["analysis"]["info"]["brainstemSsVolumes.v2"] = stats_json
 
 
@@ -382,25 +841,14 @@ def do_gear_thalamic_nuclei(subject_id, mri_dir, dry_run, environ, metadata, log
     cmd = ["segmentThalamicNuclei.sh", subject_id]
     exec_command(cmd, environ=environ, dry_run=dry_run, cont_output=True)
     tablefile = f"{OUTPUT_DIR}/{subject_id}_ThalamicNuclei.v12.T1.volumes.csv"
-    cmd = [
-        "tr",
-        "' '",
-        ",",
-        "<",
-        f"{mri_dir}/ThalamicNuclei.v12.T1.volumes.txt",
-        ">",
-        tablefile,
-    ]
-    exec_command(cmd, environ=environ, shell=True, dry_run=dry_run, cont_output=True)
+    rows = load_table(
+        f"{mri_dir}/ThalamicNuclei.v12.T1.volumes.txt", tablefile, dry_run
+    )
 
     # add those stats to metadata on the destination analysis container
-    if Path(tablefile).exists():
+    if rows:
         log.info("%s exists.  Adding to metadata.", tablefile)
-        stats_df = pd.read_csv(tablefile, names=["struc", "measure"])
-        dft = stats_df.transpose()
-        dft.columns = dft.iloc[0]
-        dft = dft[1:]
-        stats_json = dft.drop(dft.columns[0], axis=1).to_dict("records")[0]
+        stats_json = two_column_to_dict(rows)
         metadata["analysis"]["info"]["ThalamicNuclei.v12.T1.volumes"] = stats_json
     else:
         log.info("%s is missing", tablefile)
@@ -439,7 +887,7 @@ def do_gear_register_surfaces(subject_id, dry_run, environ, log):
     exec_command(cmd, environ=environ, dry_run=dry_run, cont_output=True)
 
 
-def do_gear_convert_surfaces(subject_dir, dry_run, environ, log):
+def do_gear_convert_surfaces(subject_dir, dry_run, environ, log, max_workers=1):
     """Convert selected surfaces in subject/surf to obj in output.
 
     Args:
@@ -447,6 +895,7 @@ def do_gear_convert_surfaces(subject_dir, dry_run, environ, log):
         dry_run (boolean): actually do it or do everything but
         environ (dict): shell environment saved in Dockerfile
         log (GearToolkitContext.log): logger set up by Gear Toolkit
+        max_workers (int): maximum number of surfaces to convert at once
 
     Returns:
         Nothing.
@@ -462,22 +911,81 @@ def do_gear_convert_surfaces(subject_dir, dry_run, environ, log):
         "rh.inflated",
         "lh.inflated",
     ]
-    for surf in surfaces:
-        cmd = [
-            "mris_convert",
-            f"{surf_dir}/{surf}",
-            f"{surf_dir}/{surf}.asc",
-        ]
-        exec_command(cmd, environ=environ, dry_run=dry_run, cont_output=True)
-        cmd = [
-            f"{FLYWHEEL_BASE}/utils/srf2obj",
-            f"{surf_dir}/{surf}.asc",
-            ">",
-            f"{OUTPUT_DIR}/{surf}.obj",
-        ]
-        exec_command(
-            cmd, environ=environ, shell=True, dry_run=dry_run, cont_output=True
+    # The surfaces are independent so convert them at the same time
+    stages = {
+        surf: (
+            partial(
+                convert_surface,
+                f"{surf_dir}/{surf}",
+                f"{OUTPUT_DIR}/{surf}.obj",
+                dry_run,
+                environ,
+                log,
+            ),
+            [],
         )
+        for surf in surfaces
+    }
+    run_stages(stages, log, max_workers=min(len(surfaces), max_workers))
+
+
+def convert_surface(surf_file, obj_file, dry_run, environ, log):
+    """Convert one FreeSurfer surface to an object (.obj) file.
+
+    mris_convert writes the surface as ascii and srf2obj converts that.  The
+    ascii file is a named pipe so the (large) ascii surface is passed from one
+    to the other in memory and never written to disk.  It is made outside of
+    the subject directory so this can run while the subject directory is being
+    zipped.
+
+    Args:
+        surf_file (str): the surface in the subject's surf directory
+        obj_file (str): the .obj file to write
+        dry_run (boolean): actually do it or do everything but
+        environ (dict): shell environment saved in Dockerfile
+        log (GearToolkitContext.log): logger set up by Gear Toolkit
+
+    Raises:
+        RuntimeError: if either command fails
+    """
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # mris_convert picks the format from the extension
+        asc_file = os.path.join(tmp_dir, f"{Path(surf_file).name}.asc")
+        convert_cmd = ["mris_convert", surf_file, asc_file]
+        # srf2obj writes to stdout so send that straight to the file (no shell)
+        cmd = [f"{FLYWHEEL_BASE}/utils/srf2obj", asc_file]
+        if dry_run:
+            exec_command(convert_cmd, environ=environ, dry_run=dry_run)
+            log.info("Executing command: \n %s > %s \n\n", " ".join(cmd), obj_file)
+            return
+
+        os.mkfifo(asc_file)
+        log.info("Executing command: \n %s > %s \n\n", " ".join(cmd), obj_file)
+        with open(obj_file, "w") as obj:
+            reader = subprocess.Popen(
+                cmd, stdout=obj, stderr=subprocess.PIPE, env=environ, text=True
+            )
+        try:
+            # count this with the other commands that are running
+            COMMAND_EXECUTOR.submit(
+                exec_command, convert_cmd, environ=environ, cont_output=True
+            ).result()
+            try:
+                # make sure srf2obj sees the end even if nothing was written
+                os.close(os.open(asc_file, os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                pass  # srf2obj has already read everything and finished
+            _, stderr = reader.communicate()
+        finally:
+            if reader.returncode is None:  # mris_convert did not finish
+                reader.kill()  # it could be waiting for the pipe to be opened
+                reader.communicate()
+            os.unlink(asc_file)
+
+    if reader.returncode != 0:
+        log.error(stderr)
+        raise RuntimeError(f"The following command has failed: \n{cmd}")
 
 
 def do_gear_convert_volumes(config, mri_dir, dry_run, environ, log):
@@ -521,18 +1029,25 @@ def do_gear_convert_volumes(config, mri_dir, dry_run, environ, log):
             "ThalamicNuclei.v12.T1.FSvoxelSpace.mgz",
         ]
 
+    commands = []
     for ff in mri_mgz_files:
-        cmd = [
-            "mri_convert",
-            "-i",
-            f"{mri_dir}/{ff}",
-            "-o",
-            f"{OUTPUT_DIR}/{ff.replace('.mgz', '.nii.gz')}",
-        ]
-        exec_command(cmd, environ=environ, dry_run=dry_run, cont_output=True)
-
-
-def do_gear_convert_stats(subject_id, dry_run, environ, metadata, log):
+        mgz_file = Path(f"{mri_dir}/{ff}")
+        nifti_file = Path(f"{OUTPUT_DIR}/{ff.replace('.mgz', '.nii.gz')}")
+        if not dry_run and not mgz_file.exists():
+            log.warning("%s is missing so it cannot be converted", mgz_file)
+            continue
+        if is_up_to_date(nifti_file, mgz_file, log):
+            continue
+        cmd = ["mri_convert", "-i", str(mgz_file), "-o", str(nifti_file)]
+        if ff in LABEL_VOLUMES:
+            # label numbers all fit in 16 bits, don't rescale them
+            cmd += ["-odt", "short", "--no_scale", "1"]
+        commands.append(cmd)
+    # Each conversion is independent so use as many cores as recon-all did
+    exec_commands(commands, environ, dry_run, log, max_workers=config.get("openmp"))
+
+
+def do_gear_convert_stats(subject_id, dry_run, environ, metadata, log, max_workers=1):
     """Write aseg stats to a table.
 
     Args:
@@ -541,30 +1056,30 @@ def do_gear_convert_stats(subject_id, dry_run, environ, metadata, log):
         environ (dict): shell environment saved in Dockerfile
         metadata (dict): will be written to .metadata.json when gear finishes
         log (GearToolkitContext.log): logger set up by Gear Toolkit
+        max_workers (int): maximum number of tables to export at once
 
     Returns:
         Nothing.
     """
 
     log.info("Exporting stats files csv...")
-    tablefile = f"{OUTPUT_DIR}/{subject_id}_aseg_stats_vol_mm3.csv"
-    cmd = [
-        "asegstats2table",
-        "-s",
-        subject_id,
-        "--delimiter",
-        "comma",
-        f"--tablefile={tablefile}",
-    ]
-    exec_command(cmd, environ=environ, dry_run=dry_run, cont_output=True)
+    stats_dir = SUBJECTS_DIR / subject_id / "stats"
+    commands = []
+    tablefiles = {}  # metadata key: csv file
 
-    # add those stats to metadata on the destination analysis container
-    if Path(tablefile).exists():
-        aseg_stats_df = pd.read_csv(tablefile)
-        as_json = aseg_stats_df.drop(aseg_stats_df.columns[0], axis=1).to_dict(
-            "records"
-        )[0]
-        metadata["analysis"]["info"]["aseg_stats_vol_mm3"] = as_json
+    tablefile = f"{OUTPUT_DIR}/{subject_id}_aseg_stats_vol_mm3.csv"
+    if not is_up_to_date(Path(tablefile), stats_dir / "aseg.stats", log):
+        commands.append(
+            [
+                "asegstats2table",
+                "-s",
+                subject_id,
+                "--delimiter",
+                "comma",
+                f"--tablefile={tablefile}",
+            ]
+        )
+    tablefiles["aseg_stats_vol_mm3"] = tablefile
 
     # Parse the aparc files and write to table
     hemi = ["lh", "rh"]
@@ -572,23 +1087,29 @@ def do_gear_convert_stats(subject_id, dry_run, environ, metadata, log):
     for hh in hemi:
         for pp in parc:
             tablefile = f"{OUTPUT_DIR}/{subject_id}_{hh}_{pp}_stats_area_mm2.csv"
-            cmd = [
-                "aparcstats2table",
-                "-s",
-                subject_id,
-                f"--hemi={hh}",
-                f"--delimiter=comma",
-                f"--parc={pp}",
-                f"--tablefile={tablefile}",
-            ]
-            exec_command(cmd, environ=environ, dry_run=dry_run, cont_output=True)
+            stats_file = stats_dir / f"{hh}.{pp}.stats"
+            if not is_up_to_date(Path(tablefile), stats_file, log):
+                commands.append(
+                    [
+                        "aparcstats2table",
+                        "-s",
+                        subject_id,
+                        f"--hemi={hh}",
+                        f"--delimiter=comma",
+                        f"--parc={pp}",
+                        f"--tablefile={tablefile}",
+                    ]
+                )
+            tablefiles[f"{hh}_{pp}_stats_area_mm2"] = tablefile
 
-            if Path(tablefile).exists():
-                aparc_stats_df = pd.read_csv(tablefile)
-                ap_json = aparc_stats_df.drop(
-                    aparc_stats_df.columns[0], axis=1
-                ).to_dict("records")[0]
-                metadata["analysis"]["info"][f"{hh}_{pp}_stats_area_mm2"] = ap_json
+    # The tables are independent so export them at the same time
+    exec_commands(commands, environ, dry_run, log, max_workers=max_workers)
+
+    # add those stats to metadata on the destination analysis container
+    for key, tablefile in tablefiles.items():
+        if Path(tablefile).exists():
+            stats_json = one_row_to_dict(read_csv_rows(tablefile))
+            metadata["analysis"]["info"][key] = stats_json
 
 
 def do_gtmseg(subject_id, dry_run, environ, log):
@@ -609,6 +1130,48 @@ def do_gtmseg(subject_id, dry_run, environ, log):
     exec_command(cmd, environ=environ, dry_run=dry_run, cont_output=True)
 
 
+def zip_subject_dir(output_dir, subject_id, zip_file_name, log):
+    """Zip the Freesurfer subject directory into the output directory.
+
+    Args:
+        output_dir (Path): the gear output directory
+        subject_id (str): Freesurfer subject directory name
+        zip_file_name (str): name of the zip file to create in output_dir
+        log (GearToolkitContext.log): logger set up by Gear Toolkit
+
+    Returns:
+        Nothing.
+    """
+
+    if (SUBJECTS_DIR / subject_id).exists():
+        log.info("Saving %s in %s as output", subject_id, SUBJECTS_DIR)
+        # Zip straight from SUBJECTS_DIR, not through a link in output_dir
+        zip_output(str(SUBJECTS_DIR), subject_id, str(Path(output_dir) / zip_file_name))
+
+    else:
+        log.error("Could not find %s in %s", subject_id, SUBJECTS_DIR)
+
+
+def format_messages(messages, label):
+    """List warnings or errors one per line.
+
+    Args:
+        messages (list of str or Exception): the warnings or errors
+        label (str): shown before messages that are strings, exceptions are
+            shown with their type
+
+    Returns:
+        text (str): the indented lines
+    """
+
+    return "\n".join(
+        f"  {label}: {msg}"
+        if isinstance(msg, str)
+        else f"  {type(msg).__name__}: {msg}"
+        for msg in messages
+    )
+
+
 def main(gtk_context):
 
     config = gtk_context.config
@@ -621,8 +1184,6 @@ def main(gtk_context):
     gtk_context.log_config()
     log = gtk_context.log
 
-    fw = gtk_context.client
-
     dry_run = config.get("gear-dry-run")
 
     # Keep a list of errors and warning to print all in one place at end of log
@@ -633,16 +1194,28 @@ def main(gtk_context):
     metadata = {"analysis": {"info": {}}}
 
     set_core_count(config, log)
+    set_command_workers(config["openmp"])
 
     # grab environment for gear (saved in Dockerfile)
     with open("/tmp/gear_environ.json", "r") as f:
         environ = json.load(f)
 
+        # Hand out OpenMP loop iterations as threads become free instead of
+        # in fixed blocks, and make the ITK based tools use the same number
+        # of threads as the OpenMP ones
+        if config.get("gear-omp-schedule"):
+            environ["OMP_SCHEDULE"] = config["gear-omp-schedule"]
+        environ.setdefault("OMP_DYNAMIC", "FALSE")
+        environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(config["openmp"])
+
         # Add environment to log if debugging
-        kv = ""
-        for k, v in environ.items():
-            kv += k + "=" + v + " "
-        log.debug("Environment: " + kv)
+        if log.isEnabledFor(logging.DEBUG):
+            kv = " ".join(f"{k}={v}" for k, v in environ.items())
+            log.debug("Environment: %s", kv)
+
+    # Surface tools slow down with many threads because of synchronization
+    surf_threads = min(config.get("gear-surf-threads") or 4, config["openmp"])
+    surf_environ = thread_environ(environ, surf_threads)
 
     # get config for command by skipping gear config parameters
     command_config = {}
@@ -654,20 +1227,35 @@ def main(gtk_context):
     if expert_path:
         command_config["expert"] = expert_path
 
-    # print("command_config:", json.dumps(command_config, indent=4))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("command_config: %s", json.dumps(command_config, indent=4))
     # Validate the command parameter dictionary - make sure everything is
     # ready to run so errors will appear before launching the actual gear
     # code.  Add descriptions of problems to errors & warnings lists.
-    # print("gtk_context.config:", json.dumps(gtk_context.config, indent=4))
-
-    if Path(LICENSE_FILE).exists():
-        log.debug("%s exists.", LICENSE_FILE)
-    install_freesurfer_license(gtk_context, LICENSE_FILE)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("gtk_context.config: %s", json.dumps(gtk_context.config, indent=4))
+
+    # Find everything that was provided in one pass over the input directory
+    # while the license is installed and the subject is looked up
+    scanning = COMMAND_EXECUTOR.submit(scan_inputs, INPUT_DIR, INPUT_DIRS)
+
+    # A license given to this run is always installed, but if there is already
+    # one, don't ask Flywheel for the project's license.
+    if (
+        gtk_context.get_input_path("freesurfer_license")
+        or config.get("gear-FREESURFER_LICENSE")
+        or not Path(LICENSE_FILE).exists()
+    ):
+        install_freesurfer_license(gtk_context, LICENSE_FILE)
+    else:
+        log.info("Using existing FreeSurfer license %s", LICENSE_FILE)
 
     subject_id = config.get("subject_id")
     if subject_id:
         log.debug("Got subject_id from config: %s", subject_id)
     else:
+        # Only connect to Flywheel when the subject has to be looked up
+        fw = gtk_context.client
         subject_id = fw.get_analysis(gtk_context.destination["id"]).parents.subject
         subject = fw.get_subject(subject_id)
         subject_id = subject.label
@@ -684,15 +1272,25 @@ def main(gtk_context):
         subject_id = new_subject_id
     log.info("Using '%s' as subject_id", subject_id)
 
-    subject_dir = Path(SUBJECTS_DIR / subject_id)
-    work_dir = gtk_context.output_dir / subject_id
-    if not work_dir.is_symlink():
-        work_dir.symlink_to(subject_dir)
+    subject_dir = SUBJECTS_DIR / subject_id
+    mri_dir = f"{subject_dir}/mri"
 
     if "subject_id" in command_config:  # this was already handled
         command_config.pop("subject_id")
 
-    command = generate_command(subject_id, command_config, log)
+    command = generate_command(
+        subject_id, command_config, log, inputs=scanning.result()
+    )
+
+    # zip entire output/<subject_id> folder into
+    #  <gear_name>_<subject_id>_<analysis.id>.zip
+    zip_file_name = (
+        gtk_context.manifest["name"]
+        + f"_{subject_id}_{gtk_context.destination['id']}.zip"
+    )
+    # Post-processing stages that don't depend on each other run at once
+    max_workers = 3 if config.get("gear-parallel-post", True) else 1
+    completed = set()  # post-processing stages that have finished
 
     num_tries = 0
     return_code = 0
@@ -710,6 +1308,7 @@ def main(gtk_context):
 
             try:
                 num_tries += 1
+                completed.clear()
 
                 if dry_run:
                     e = "gear-dry-run is set: Command was NOT run."
@@ -730,46 +1329,167 @@ def main(gtk_context):
                     }
 
                 # This is what it is all about
+                recon_command, recon_environ = set_thread_placement(
+                    command, environ, config, log
+                )
+                # A shell is needed for "time" (a shell keyword) to report
+                # what recon-all used, so quote everything it runs
                 exec_command(
-                    command,
-                    environ=environ,
+                    [shlex.quote(arg) for arg in recon_command],
+                    environ=recon_environ,
                     dry_run=dry_run,
                     shell=True,
                     cont_output=True,
                 )
 
-                # Optional Segmentations
-                mri_dir = f"{subject_dir}/mri"
+                # Optional post-processing.  Each stage is started as soon as
+                # the stages it depends on are done.
+                segmentations = [
+                    "hippocampal_subfields",
+                    "brainstem_structures",
+                    "thalamic_nuclei",
+                ]
+                stages = {}
+
+                # The segmentations and gtmseg are the heavy multi-threaded
+                # stages.  When they run at the same time they share the cores.
+                heavy = [
+                    key
+                    for key in [
+                        "gear-hippocampal_subfields",
+                        "gear-brainstem_structures",
+                        "gear-gtmseg",
+                    ]
+                    if config.get(key)
+                ]
+                seg_environ = environ
+                if max_workers > 1 and len(heavy) > 1:
+                    seg_environ = thread_environ(
+                        environ, max(config["openmp"] // len(heavy), 1)
+                    )
 
                 if config.get("gear-hippocampal_subfields"):
-                    do_gear_hippocampal_subfields(
-                        subject_id, mri_dir, dry_run, environ, metadata, log
+                    stages["hippocampal_subfields"] = (
+                        partial(
+                            do_gear_hippocampal_subfields,
+                            subject_id,
+                            mri_dir,
+                            dry_run,
+                            seg_environ,
+                            metadata,
+                            log,
+                        ),
+                        [],
                     )
 
                 if config.get("gear-brainstem_structures"):
-                    do_gear_brainstem_structures(
-                        subject_id, mri_dir, dry_run, environ, metadata, log
+                    stages["brainstem_structures"] = (
+                        partial(
+                            do_gear_brainstem_structures,
+                            subject_id,
+                            mri_dir,
+                            dry_run,
+                            seg_environ,
+                            metadata,
+                            log,
+                        ),
+                        [],
                     )
 
                 if config.get("gear-thalamic_nuclei"):
-                    do_gear_thalamic_nuclei(
-                        subject_id, mri_dir, dry_run, environ, metadata, log
-                    )
+
+                    def thalamic_nuclei():
+                        # This waits for the other segmentations so it only
+                        # shares the cores if gtmseg is still running
+                        thal_environ = environ
+                        if (
+                            max_workers > 1
+                            and "gtmseg" in stages
+                            and "gtmseg" not in completed
+                        ):
+                            thal_environ = thread_environ(
+                                environ, max(config["openmp"] // 2, 1)
+                            )
+                        do_gear_thalamic_nuclei(
+                            subject_id, mri_dir, dry_run, thal_environ, metadata, log
+                        )
+
+                    stages["thalamic_nuclei"] = (thalamic_nuclei, segmentations[:2])
 
                 if config.get("gear-register_surfaces"):
-                    do_gear_register_surfaces(subject_id, dry_run, environ, log)
+                    stages["register_surfaces"] = (
+                        partial(
+                            do_gear_register_surfaces,
+                            subject_id,
+                            dry_run,
+                            surf_environ,
+                            log,
+                        ),
+                        [],
+                    )
 
                 if config.get("gear-convert_surfaces"):
-                    do_gear_convert_surfaces(subject_dir, dry_run, environ, log)
+                    stages["convert_surfaces"] = (
+                        partial(
+                            do_gear_convert_surfaces,
+                            subject_dir,
+                            dry_run,
+                            surf_environ,
+                            log,
+                            max_workers=config["openmp"],
+                        ),
+                        [],
+                    )
 
                 if config.get("gear-gtmseg"):
-                    do_gtmseg(subject_id, dry_run, environ, log)
+                    stages["gtmseg"] = (
+                        partial(do_gtmseg, subject_id, dry_run, seg_environ, log),
+                        [],
+                    )
 
                 if config.get("gear-convert_volumes"):
-                    do_gear_convert_volumes(config, mri_dir, dry_run, environ, log)
+                    stages["convert_volumes"] = (
+                        partial(
+                            do_gear_convert_volumes,
+                            config,
+                            mri_dir,
+                            dry_run,
+                            environ,
+                            log,
+                        ),
+                        segmentations + ["gtmseg"],
+                    )
 
                 if config.get("gear-convert_stats"):
-                    do_gear_convert_stats(subject_id, dry_run, environ, metadata, log)
+                    stages["convert_stats"] = (
+                        partial(
+                            do_gear_convert_stats,
+                            subject_id,
+                            dry_run,
+                            environ,
+                            metadata,
+                            log,
+                            max_workers=config["openmp"],
+                        ),
+                        [],
+                    )
+
+                # Zip once nothing else will change the subject directory.  It
+                # is the last stage so with one worker (gear-parallel-post off)
+                # everything runs in the original order and the converted
+                # outputs are finished before zipping.
+                stages["zip"] = (
+                    partial(
+                        zip_subject_dir,
+                        gtk_context.output_dir,
+                        subject_id,
+                        zip_file_name,
+                        log,
+                    ),
+                    segmentations + ["register_surfaces", "gtmseg"],
+                )
+
+                run_stages(stages, log, max_workers=max_workers, completed=completed)
 
                 didnt_run_yet = False  # If here, no error so it did run
 
@@ -780,56 +1500,24 @@ def main(gtk_context):
                 return_code = 1
                 command = remove_i_args(command)  # try again with -i <arg> removed
 
-    # zip entire output/<subject_id> folder into
-    #  <gear_name>_<subject_id>_<analysis.id>.zip
-    zip_file_name = (
-        gtk_context.manifest["name"]
-        + f"_{subject_id}_{gtk_context.destination['id']}.zip"
-    )
-    if subject_dir.exists():
-        log.info("Saving %s in %s as output", subject_id, SUBJECTS_DIR)
-        zip_output(str(gtk_context.output_dir), subject_id, zip_file_name)
-
-    else:
-        log.error("Could not find %s in %s", subject_id, SUBJECTS_DIR)
-
-    # clean up: remove output that was zipped
-    if work_dir.exists():
-        log.debug('removing output directory "%s"', str(work_dir))
-        work_dir.unlink()
-    else:
-        log.info("Output directory does not exist so it cannot be removed")
+    if "zip" not in completed:
+        zip_subject_dir(gtk_context.output_dir, subject_id, zip_file_name, log)
 
     # Report errors and warnings at the end of the log so they can be easily seen.
     if len(warnings) > 0:
-        msg = "Previous warnings:\n"
-        for err in warnings:
-            if str(type(err)).split("'")[1] == "str":
-                # show string
-                msg += "  Warning: " + str(err) + "\n"
-            else:  # show type (of warning) and warning message
-                err_type = str(type(err)).split("'")[1]
-                msg += f"  {err_type}: {str(err)}\n"
-        log.info(msg)
+        log.info("Previous warnings:\n%s\n", format_messages(warnings, "Warning"))
 
     if len(errors) > 0:
-        msg = "Previous errors:\n"
-        for err in errors:
-            if str(type(err)).split("'")[1] == "str":
-                # show string
-                msg += "  Error msg: " + str(err) + "\n"
-            else:  # show type (of error) and error message
-                err_type = str(type(err)).split("'")[1]
-                msg += f"  {err_type}: {str(err)}\n"
-        log.info(msg)
+        log.info("Previous errors:\n%s\n", format_messages(errors, "Error msg"))
 
     if len(metadata["analysis"]["info"]) > 0:
         with open(f"{gtk_context.output_dir}/.metadata.json", "w") as fff:
-            json.dump(metadata, fff)
+            json.dump(metadata, fff, separators=(",", ":"))
         log.info(f"Wrote {gtk_context.output_dir}/.metadata.json")
     else:
         log.info("No data available to save in .metadata.json.")
-    log.debug(".metadata.json: %s", json.dumps(metadata, indent=4))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(".metadata.json: %s", json.dumps(metadata, indent=4))
 
     news = "succeeded" if return_code == 0 else "failed"
 
@@ -1,19 +1,37 @@
 #!/usr/bin/env python3
-"""Copy a directory hierarchy by creating directories and touching files. """
+"""Copy a directory hierarchy by creating directories and touching files.
 
+Use -q to not list what is found.
+"""
+
+import os
+import sys
 from pathlib import Path
 
+verbose = "-q" not in sys.argv[1:]
+cwd = os.getcwd()
+
 fake = Path("fake")
 if fake.exists():
     fake.rmdir()
 fake.mkdir()
 
-found = [f for f in Path().cwd().rglob("*")]
-for ff in found:
-    if ff.is_dir():
-        print("found dir", ff)
-        print(str(fake / ff.relative_to(Path.cwd())))
-        Path(fake / ff.relative_to(Path.cwd())).mkdir()
-    elif ff.is_file():
-        print("found file", ff.relative_to(Path.cwd()))
-        Path(fake / ff.relative_to(Path.cwd())).touch()
+for root, dirs, files, _ in os.fwalk("."):
+    rel = os.path.relpath(root, ".")
+    if rel == ".":
+        dirs.remove("fake")  # don't copy the copy
+    # create everything relative to the new directory, so each path is
+    # only looked up once
+    target = os.open(fake / rel, os.O_RDONLY)
+    try:
+        for name in dirs:
+            if verbose:
+                print("found dir", os.path.normpath(os.path.join(cwd, rel, name)))
+                print(os.path.normpath(os.path.join(fake, rel, name)))
+            os.mkdir(name, dir_fd=target)
+        for name in files:
+            if verbose:
+                print("found file", os.path.normpath(os.path.join(rel, name)))
+            os.close(os.open(name, os.O_CREAT | os.O_WRONLY, 0o644, dir_fd=target))
+    finally:
+        os.close(target)
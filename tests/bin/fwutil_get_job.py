@@ -28,9 +28,13 @@
 import json
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import flywheel_gear_toolkit
 
+# Number of input files to download at the same time
+MAX_DOWNLOADS = 4
+
 
 def build_local_test(job, test_path_root):
     """
@@ -44,13 +48,8 @@ def build_local_test(job, test_path_root):
     input_dir = os.path.join(test_path, "input")
     output_dir = os.path.join(test_path, "output")
 
-    if not os.path.isdir(input_dir):
-        print("Creating directory: %s" % input_dir)
-        os.makedirs(input_dir)
-
-    if not os.path.isdir(output_dir):
-        print("Creating directory: %s" % output_dir)
-        os.mkdir(output_dir)
+    os.makedirs(input_dir, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
 
     # Write the config file
     config_file = os.path.join(test_path, "config.json")
@@ -60,6 +59,7 @@ def build_local_test(job, test_path_root):
     # For each key in input, make the directory and download the data
     input_data = job.config.get("inputs")
 
+    downloads = []
     for k in input_data:
 
         if k == "api_key":
@@ -69,11 +69,7 @@ def build_local_test(job, test_path_root):
 
         # Make the directory
         ipath = os.path.join(input_dir, k)
-        if os.path.exists(ipath):
-            print("Exists: %s" % ipath)
-        else:
-            os.mkdir(ipath)
-            print("Created directory: %s" % ipath)
+        os.makedirs(ipath, exist_ok=True)
 
         # Download the file to the directory
         ifilename = _input["location"]["name"]
@@ -83,12 +79,27 @@ def build_local_test(job, test_path_root):
         if os.path.isfile(ifilepath):
             print("Exists: %s" % ifilename)
         else:
-            print("Downloading: %s" % ifilename)
-            fw.download_file_from_container(iparentid, ifilename, ifilepath)
+            downloads.append((iparentid, ifilename, ifilepath))
+
+    # Download all of the files at the same time.  The client's session keeps
+    # its connections open so they are reused.
+    with ThreadPoolExecutor(max_workers=MAX_DOWNLOADS) as executor:
+        futures = [executor.submit(download, *args) for args in downloads]
+    for future in futures:
+        future.result()  # raise any download error
 
     print("Done!")
 
 
+def download(iparentid, ifilename, ifilepath):
+    """
+    Download one input file
+    """
+
+    print("Downloading: %s" % ifilename)
+    fw.download_file_from_container(iparentid, ifilename, ifilepath)
+
+
 if __name__ == "__main__":
     """
     Given a Flywheel job id, this script will generate a local testing directory
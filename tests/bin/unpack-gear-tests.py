@@ -12,9 +12,73 @@ Example:
 import argparse
 import glob
 import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 from zipfile import ZipFile
 
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Info-ZIP is only faster than zipfile when there is a lot to extract
+LARGE_TEST_SIZE = 100 * 1024 * 1024
+
+
+def extract_all(test, name):
+    """Extract a zip file like ZipFile.extractall() but faster.
+
+    Files are copied with a large buffer by several threads, each with its
+    own ZipFile (they cannot be shared).  Directories are made first so the
+    threads do not race to make them.
+
+    Args:
+        test (str): the test .zip file
+        name (str): directory to extract into
+    """
+
+    top = os.path.realpath(name)
+    files = []
+    with ZipFile(test, "r") as zip_file:
+        for info in zip_file.infolist():
+            target = os.path.realpath(os.path.join(name, info.filename))
+            if not target.startswith(top + os.sep):
+                print(f"Ignoring {info.filename}, it is outside of {name}")
+            elif info.is_dir():
+                os.makedirs(target, exist_ok=True)
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                files.append((info, target))
+
+    # Give each thread about the same number of bytes, biggest files first
+    n_shards = min(os.cpu_count() or 1, len(files)) or 1
+    shards = [[] for _ in range(n_shards)]
+    sizes = [0] * n_shards
+    for info, target in sorted(files, key=lambda f: -f[0].file_size):
+        smallest = sizes.index(min(sizes))
+        shards[smallest].append((info, target))
+        sizes[smallest] += info.file_size
+
+    with ThreadPoolExecutor(max_workers=n_shards) as executor:
+        list(executor.map(partial(extract_files, test), shards))
+
+
+def extract_files(test, files):
+    """Extract some files from a zip file.
+
+    Args:
+        test (str): the test .zip file
+        files (list of (ZipInfo, str)): members and where to write them
+    """
+
+    with ZipFile(test, "r") as zip_file:
+        for info, target in files:
+            with zip_file.open(info) as src, open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+            mode = info.external_attr >> 16
+            if mode:
+                os.chmod(target, mode & 0o7777)
+
 
 def main():
 
@@ -52,12 +116,15 @@ def main():
         if args.verbose > 0:
             print(f'"{test}" --> "{name}"')
 
-        if Path(name).exists():
+        if os.path.exists(name):
             print(f"{name} already exists, not unzipping.")
         else:
             print(f"Unzipping {name}.")
-            zip_file = ZipFile(test, "r")
-            zip_file.extractall(name)
+            if shutil.which("unzip") and os.path.getsize(test) > LARGE_TEST_SIZE:
+                # Info-ZIP is faster than zipfile on big tests
+                subprocess.run(["unzip", "-q", test, "-d", name], check=True)
+            else:
+                extract_all(test, name)
 
     return exit_code
 
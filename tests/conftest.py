@@ -1,6 +1,9 @@
+import hashlib
 import json
 import os
 import shutil
+import tempfile
+import threading
 from pathlib import Path
 
 import pytest
@@ -9,6 +12,41 @@ from flywheel_gear_toolkit.utils.zip_tools import unzip_archive
 fs_dir = Path("/usr/local/freesurfer/")
 subjects_dir = Path(fs_dir / "subjects")
 
+gear_cache = Path(tempfile.gettempdir()) / "gear_cache"
+
+
+def extract_cached(zip_path):
+    """Unzip a simulated gear once and return where it was unzipped.
+
+    The unzipped gear is kept in a directory named by the hash of the zip file
+    so a changed zip file is unzipped again.
+
+    Args:
+        zip_path (str): the zip file that holds the simulated gear
+
+    Returns:
+        cached (Path): directory with the unzipped gear
+    """
+
+    digest = hashlib.sha1(Path(zip_path).read_bytes()).hexdigest()
+    cached = gear_cache / digest
+    if not (cached / ".done").exists():
+        shutil.rmtree(cached, ignore_errors=True)
+        unzip_archive(zip_path, str(cached))
+        (cached / ".done").touch()
+
+    return cached
+
+
+@pytest.fixture(scope="session")
+def require_api_key():
+    """Skip the test unless there is an API key, only looking once a session"""
+
+    user_json = Path.home() / ".config/flywheel/user.json"
+    if not user_json.exists():
+        pytest.skip(f"No API key available in {str(user_json)}")
+    return user_json
+
 
 @pytest.fixture
 def install_gear():
@@ -30,13 +68,26 @@ def install_gear():
         if Path(gear + "config.json").exists():
             Path(gear + "config.json").unlink()
 
+        # Renaming is quick so move the old directories out of the way and
+        # delete them while the new gear is installed
+        trash = Path(tempfile.mkdtemp(prefix=".trash.", dir=gear))
         for dir_name in ["input", "output", "work", "freesurfer"]:
             path = Path(gear + dir_name)
             if path.exists():
-                shutil.rmtree(path)
+                path.rename(trash / dir_name)
+        threading.Thread(
+            target=shutil.rmtree, args=(trash,), kwargs={"ignore_errors": True}
+        ).start()
 
         print(f'\ninstalling new gear, "{zip_name}"...')
-        unzip_archive(gear_tests + zip_name, gear)
+        # Copying is faster than unzipping again.  Hard links would let a test
+        # change the cached files.
+        shutil.copytree(
+            extract_cached(gear_tests + zip_name),
+            gear,
+            ignore=shutil.ignore_patterns(".done"),
+            dirs_exist_ok=True,
+        )
 
         # move freesurfer license and subject directories to proper place
         gear_freesurfer = Path("freesurfer")
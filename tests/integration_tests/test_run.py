@@ -6,8 +6,6 @@ import logging
 import os
 import shutil
 import zipfile
-from pathlib import Path
-from unittest import TestCase
 
 import flywheel_gear_toolkit
 import pytest
@@ -25,11 +23,9 @@ DRY_FILE = (
 )
 
 
-def test_dry_run_works(capfd, install_gear, print_captured, search_sysout):
-
-    user_json = Path(Path.home() / ".config/flywheel/user.json")
-    if not user_json.exists():
-        TestCase.skipTest("", f"No API key available in {str(user_json)}")
+def test_dry_run_works(
+    capfd, require_api_key, install_gear, print_captured, search_sysout
+):
 
     install_gear("dry_run.zip")
 
@@ -69,11 +65,9 @@ def test_dry_run_works(capfd, install_gear, print_captured, search_sysout):
         assert "Midbrain" in metadata["analysis"]["info"]["brainstemSsVolumes.v2"]
 
 
-def test_prev_works(capfd, install_gear, print_captured, search_sysout):
-
-    user_json = Path(Path.home() / ".config/flywheel/user.json")
-    if not user_json.exists():
-        TestCase.skipTest("", f"No API key available in {str(user_json)}")
+def test_prev_works(
+    capfd, require_api_key, install_gear, print_captured, search_sysout
+):
 
     install_gear("prev.zip")
 
@@ -93,11 +87,9 @@ def test_prev_works(capfd, install_gear, print_captured, search_sysout):
         assert "-subjid TOME_3024" in command
 
 
-def test_nii2_works(capfd, install_gear, print_captured, search_sysout):
-
-    user_json = Path(Path.home() / ".config/flywheel/user.json")
-    if not user_json.exists():
-        TestCase.skipTest("", f"No API key available in {str(user_json)}")
+def test_nii2_works(
+    capfd, require_api_key, install_gear, print_captured, search_sysout
+):
 
     install_gear("nii2.zip")
 
@@ -122,11 +114,9 @@ def test_nii2_works(capfd, install_gear, print_captured, search_sysout):
         assert "-openmp" in command
 
 
-def test_dcm_zip_works(capfd, search_sysout, install_gear, print_captured):
-
-    user_json = Path(Path.home() / ".config/flywheel/user.json")
-    if not user_json.exists():
-        TestCase.skipTest("", f"No API key available in {str(user_json)}")
+def test_dcm_zip_works(
+    capfd, require_api_key, search_sysout, install_gear, print_captured
+):
 
     install_gear("dcm_zip.zip")
 
@@ -151,15 +141,13 @@ def test_dcm_zip_works(capfd, search_sysout, install_gear, print_captured):
         assert "-openmp" in command
 
 
-def test_wet_run_fails(capfd, search_sysout, install_gear, print_captured):
+def test_wet_run_fails(
+    capfd, require_api_key, search_sysout, install_gear, print_captured
+):
 
     # clean up after previous tests so this one will run
     shutil.rmtree("/usr/local/freesurfer/subjects/TOME_3024")
 
-    user_json = Path(Path.home() / ".config/flywheel/user.json")
-    if not user_json.exists():
-        TestCase.skipTest("", f"No API key available in {str(user_json)}")
-
     install_gear("wet_run.zip")
 
     with flywheel_gear_toolkit.GearToolkitContext(input_args=[]) as gtk_context:
@@ -0,0 +1,42 @@
+"""Unit tests for convert_surface"""
+
+import logging
+import subprocess
+
+import pytest
+
+import run
+
+log = logging.getLogger(__name__)
+
+
+def test_convert_surface_missing_program_cleans_up(tmp_path, monkeypatch):
+
+    srf2obj = tmp_path / "utils/srf2obj"
+    srf2obj.parent.mkdir()
+    srf2obj.write_text('#!/bin/sh\nexec /bin/cat "$1"\n')
+    srf2obj.chmod(0o755)
+    monkeypatch.setattr(run, "FLYWHEEL_BASE", tmp_path)
+
+    readers = []
+    real_popen = subprocess.Popen
+
+    def popen(*args, **kwargs):
+        readers.append(real_popen(*args, **kwargs))
+        return readers[-1]
+
+    monkeypatch.setattr(run.subprocess, "Popen", popen)
+
+    # mris_convert can't be found so it is never started
+    with pytest.raises(FileNotFoundError):
+        run.convert_surface(
+            str(tmp_path / "lh.pial"),
+            str(tmp_path / "lh.pial.obj"),
+            False,
+            {"PATH": str(tmp_path / "nothing_here")},
+            log,
+        )
+
+    # srf2obj is not left waiting for the pipe
+    assert readers[0].returncode is not None
+    assert not list(tmp_path.glob("**/*.asc"))
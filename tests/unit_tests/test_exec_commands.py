@@ -0,0 +1,33 @@
+"""Unit tests for exec_commands"""
+
+import logging
+
+import pytest
+
+from run import exec_commands
+
+log = logging.getLogger(__name__)
+
+
+def test_exec_commands_runs_all(caplog, search_caplog):
+
+    caplog.set_level(logging.DEBUG)
+
+    commands = [["echo", "one"], ["echo", "two"], ["echo", "three"]]
+
+    exec_commands(commands, None, True, log)
+
+    assert search_caplog(caplog, "echo one")
+    assert search_caplog(caplog, "echo two")
+    assert search_caplog(caplog, "echo three")
+
+
+def test_exec_commands_failure_raises_after_all_run(tmp_path):
+
+    touched = tmp_path / "touched"
+    commands = [["false"], ["touch", str(touched)]]
+
+    with pytest.raises(RuntimeError):
+        exec_commands(commands, None, False, log)
+
+    assert touched.exists()
@@ -0,0 +1,48 @@
+import zipfile
+
+import pytest
+
+from run import extract_members
+
+FILES = [
+    "subject/mri/T1.mgz",
+    "subject/surf/lh.white",
+    "subject/surf/rh.white",
+    "subject/scripts/recon-all.log",
+]
+
+
+def test_extract_members_works(tmp_path):
+
+    archive = tmp_path / "freesurfer-recon-all_subject.zip"
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("subject/label/", "")
+        for afile in FILES:
+            zf.writestr(afile, afile)
+    with zipfile.ZipFile(archive) as zf:
+        members = zf.infolist()
+
+    extract_members(archive, members, tmp_path / "subjects", max_workers=3)
+
+    assert (tmp_path / "subjects/subject/label").is_dir()
+    for afile in FILES:
+        assert (tmp_path / "subjects" / afile).read_text() == afile
+
+
+@pytest.mark.parametrize(
+    "name", ["../escaped_dir/f.txt", "/tmp/f.txt", "a/../../f.txt"]
+)
+def test_extract_members_outside_dest_fails(tmp_path, name):
+
+    archive = tmp_path / "freesurfer-recon-all_subject.zip"
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("subject/mri/T1.mgz", "T1")
+        zf.writestr(name, "escaped")
+    with zipfile.ZipFile(archive) as zf:
+        members = zf.infolist()
+
+    with pytest.raises(ValueError):
+        extract_members(archive, members, tmp_path / "subjects/sub", max_workers=2)
+
+    # nothing is written before the bad name is found
+    assert not (tmp_path / "subjects").exists()
@@ -1,5 +1,7 @@
 import json
 import logging
+import os
+from functools import lru_cache
 from pathlib import Path
 from unittest import TestCase
 
@@ -12,14 +14,24 @@ subjects_dir = Path(fs_dir / "subjects")
 log = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=1)
+def read_gear_environ():
+    with open("/tmp/gear_environ.json", "rb") as f:
+        return json.loads(f.read())
+
+
+def gear_environ():
+    """Return a copy of the environment the gear saved, read only once."""
+    return dict(read_gear_environ())
+
+
 def test_convert_stats_works(caplog, install_gear, print_caplog):
 
     caplog.set_level(logging.DEBUG)
 
     install_gear("stats.zip")
 
-    with open("/tmp/gear_environ.json", "r") as f:
-        environ = json.load(f)
+    environ = gear_environ()
 
     metadata = {"analysis": {"info": {}}}
 
@@ -46,8 +58,7 @@ def test_convert_volumes_works(caplog, install_gear, print_caplog):
 
     mri_dir = f"{str(subjects_dir)}/sub-TOME3024/mri"
 
-    with open("/tmp/gear_environ.json", "r") as f:
-        environ = json.load(f)
+    environ = gear_environ()
 
     config = {
         "gear-hippocampal_subfields": True,
@@ -72,8 +83,7 @@ def test_brainstem_works(caplog, install_gear, print_caplog):
 
     metadata = {"analysis": {"info": {}}}
 
-    with open("/tmp/gear_environ.json", "r") as f:
-        environ = json.load(f)
+    environ = gear_environ()
 
     run.do_gear_brainstem_structures(
         "sub-TOME3024", mri_dir, False, environ, metadata, log
@@ -96,8 +106,7 @@ def test_hippo_works(caplog, install_gear, print_caplog):
 
     mri_dir = f"{str(subjects_dir)}/sub-TOME3024/mri"
 
-    with open("/tmp/gear_environ.json", "r") as f:
-        environ = json.load(f)
+    environ = gear_environ()
 
     # This takes 20 minutes!
     run.do_gear_hippocampal_subfields(
@@ -113,8 +122,7 @@ def test_gtmseg_dry_run_works(caplog, search_caplog, print_caplog):
 
     caplog.set_level(logging.DEBUG)
 
-    with open("/tmp/gear_environ.json", "r") as f:
-        environ = json.load(f)
+    environ = gear_environ()
 
     run.do_gtmseg("sub-TOME3024", True, environ, log)
 
@@ -131,8 +139,7 @@ def test_do_gear_thalamic_nuclei_dry_run_works(
 
     install_gear("thalamic.zip")
 
-    with open("/tmp/gear_environ.json", "r") as f:
-        environ = json.load(f)
+    environ = gear_environ()
 
     metadata = {"analysis": {"info": {}}}
 
@@ -150,3 +157,53 @@ def test_do_gear_thalamic_nuclei_dry_run_works(
         ]
         == 7476.300538
     )
+
+
+def test_spaces_to_csv_works(tmp_path):
+
+    txt_file = tmp_path / "brainstemSsVolumes.v2.txt"
+    txt_file.write_text("medulla 4567.8\npons 1234.5\n")
+    csv_file = tmp_path / "brainstemSsVolumes.v2.csv"
+
+    run.spaces_to_csv(txt_file, csv_file, True)
+    assert not csv_file.exists()
+
+    rows = run.spaces_to_csv(txt_file, csv_file, False)
+    assert rows == [["medulla", "4567.8"], ["pons", "1234.5"]]
+    assert csv_file.read_text() == "medulla,4567.8\npons,1234.5\n"
+
+
+def test_is_up_to_date_works(tmp_path):
+
+    source = tmp_path / "aseg.stats"
+    output = tmp_path / "aseg_stats_vol_mm3.csv"
+
+    assert not run.is_up_to_date(output, source, log)
+
+    source.touch()
+    output.touch()
+    assert run.is_up_to_date(output, source, log)
+
+    os.utime(source, (output.stat().st_atime, output.stat().st_mtime + 10))
+    assert not run.is_up_to_date(output, source, log)
+
+
+def test_read_tables_works(tmp_path):
+
+    two_column = tmp_path / "lh.hippoSfVolumes-T1.v21.csv"
+    two_column.write_text("Hippocampal_tail,679.421829\nsubiculum-body,252.005035\n")
+    one_row = tmp_path / "brainstemSsVolumes.v2.csv"
+    one_row.write_text(
+        "Subject,Medulla,Pons,NumVert\nsub-TOME3024,4868.15,15390.2,129534\n"
+    )
+
+    assert run.two_column_to_dict(run.read_csv_rows(two_column)) == {
+        "Hippocampal_tail": 679.421829,
+        "subiculum-body": 252.005035,
+    }
+    assert run.one_row_to_dict(run.read_csv_rows(one_row)) == {
+        "Medulla": 4868.15,
+        "Pons": 15390.2,
+        "NumVert": 129534,
+    }
+    assert isinstance(run.one_row_to_dict(run.read_csv_rows(one_row))["NumVert"], int)
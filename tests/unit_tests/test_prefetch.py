@@ -0,0 +1,18 @@
+import logging
+
+from utils.fly.prefetch import prefetch
+
+log = logging.getLogger(__name__)
+
+
+def test_prefetch_skips_missing_files(tmp_path):
+
+    afile = tmp_path / "afile.txt"
+    afile.write_text("Nothing to see here.")
+
+    thread = prefetch([afile, tmp_path / "missing.txt"])
+
+    if thread:
+        thread.join()
+        assert not thread.is_alive()
+    assert afile.read_text() == "Nothing to see here."
@@ -0,0 +1,46 @@
+"""Unit tests for run_stages"""
+
+import logging
+
+import pytest
+
+from run import run_stages
+
+log = logging.getLogger(__name__)
+
+
+def test_run_stages_serial_keeps_order():
+
+    ran = []
+    stages = {
+        "first": (lambda: ran.append("first"), []),
+        "second": (lambda: ran.append("second"), ["first"]),
+        "third": (lambda: ran.append("third"), ["not_enabled"]),
+    }
+    completed = set()
+
+    run_stages(stages, log, max_workers=1, completed=completed)
+
+    assert ran == ["first", "second", "third"]
+    assert completed == {"first", "second", "third"}
+
+
+def test_run_stages_skips_dependents_of_failure():
+
+    ran = []
+
+    def fail():
+        raise RuntimeError("Nope")
+
+    stages = {
+        "fails": (fail, []),
+        "depends": (lambda: ran.append("depends"), ["fails"]),
+        "independent": (lambda: ran.append("independent"), []),
+    }
+    completed = set()
+
+    with pytest.raises(RuntimeError):
+        run_stages(stages, log, max_workers=3, completed=completed)
+
+    assert ran == ["independent"]
+    assert completed == {"independent"}
@@ -0,0 +1,42 @@
+"""Unit test for scan_inputs"""
+
+from pathlib import Path
+
+from run import scan_inputs
+
+FILES = [
+    "anatomical/T1w.nii.gz",
+    "anatomical/.hidden_file",
+    "anatomical/.hidden_dir/T1w.nii.gz",
+    "t2w_anatomical/sub/T2w.nii.gz",
+    "loose_file",
+]
+
+
+def test_scan_inputs_works(tmp_path):
+
+    for afile in FILES:
+        Path(tmp_path / afile).parent.mkdir(parents=True, exist_ok=True)
+        Path(tmp_path / afile).touch()
+
+    found = scan_inputs(tmp_path)
+
+    assert found["anatomical"] == [tmp_path / "anatomical/T1w.nii.gz"]
+    assert found["t2w_anatomical"] == [tmp_path / "t2w_anatomical/sub/T2w.nii.gz"]
+    assert found[""] == [tmp_path / "loose_file"]
+
+
+def test_scan_inputs_despaces(tmp_path):
+
+    afile = tmp_path / "anatomical/a dir/a file.nii.gz"
+    afile.parent.mkdir(parents=True)
+    afile.touch()
+    expert = tmp_path / "expert/expert opts.txt"
+    expert.parent.mkdir()
+    expert.touch()
+
+    found = scan_inputs(tmp_path, ["anatomical"])
+
+    assert found["anatomical"] == [tmp_path / "anatomical/a_dir/a_file.nii.gz"]
+    assert found["expert"] == [expert]
+    assert expert.exists()
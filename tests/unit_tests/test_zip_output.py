@@ -0,0 +1,39 @@
+"""Unit test for zip_output"""
+
+import zipfile
+from pathlib import Path
+
+from utils.fly.zip_output import zip_output
+
+FILES = [
+    "subject/mri/T1.mgz",
+    "subject/mri/transforms/talairach.m3z",
+    "subject/scripts/recon-all.log",
+    "subject/scripts/exclude-me.txt",
+]
+
+
+def test_zip_output_works(tmp_path):
+
+    for afile in FILES:
+        Path(tmp_path / afile).parent.mkdir(parents=True, exist_ok=True)
+        Path(tmp_path / afile).write_text("recon-all " * 100)
+
+    zip_output(
+        str(tmp_path),
+        "subject",
+        "subject.zip",
+        exclude_files=["subject/scripts/exclude-me.txt"],
+    )
+
+    with zipfile.ZipFile(tmp_path / "subject.zip") as zf:
+        assert zf.testzip() is None
+        infos = {info.filename: info for info in zf.infolist()}
+        assert zf.read("subject/scripts/recon-all.log") == b"recon-all " * 100
+
+    assert infos["subject/mri/T1.mgz"].compress_type == zipfile.ZIP_STORED
+    m3z_info = infos["subject/mri/transforms/talairach.m3z"]
+    assert m3z_info.compress_type == zipfile.ZIP_STORED
+    assert infos["subject/scripts/recon-all.log"].compress_type == zipfile.ZIP_DEFLATED
+    assert "subject/scripts/exclude-me.txt" not in infos
+    assert "subject/mri/" in infos
@@ -1,6 +1,5 @@
 import logging
 import os
-import shutil
 
 log = logging.getLogger(__name__)
 
@@ -13,13 +12,26 @@ def despace(directory):
     """
 
     for root, dirs, files in os.walk(directory, topdown=False):
-        for dd in dirs:
-            if " " in dd:
-                new = dd.replace(" ", "_")
-                log.debug(f"'{root}/{dd}' -> '{root}/{new}'")
-                shutil.move(f"{root}/{dd}", f"{root}/{new}")
-        for ff in files:
-            if " " in ff:
-                new = ff.replace(" ", "_")
-                log.debug(f"'{root}/{ff}' -> '{root}/{new}'")
-                shutil.move(f"{root}/{ff}", f"{root}/{new}")
+        for name in dirs + files:
+            despace_name(root, name)
+
+
+def despace_name(directory, name):
+    """Replace spaces with underscores in the name of one file or directory.
+
+    Args:
+        directory (str): the directory the file or directory is in
+        name (str): the name of the file or directory
+
+    Returns:
+        new (str): the name it has now
+    """
+
+    if " " not in name:
+        return name
+
+    new = name.replace(" ", "_")
+    log.debug(f"'{directory}/{name}' -> '{directory}/{new}'")
+    os.rename(f"{directory}/{name}", f"{directory}/{new}")
+
+    return new
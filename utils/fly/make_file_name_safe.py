@@ -5,6 +5,9 @@ import re
 
 log = logging.getLogger(__name__)
 
+# anything that is not alphanumeric, underscore, dash, or period
+SAFE_PATTERN = re.compile(r"[^A-Za-z0-9_\-.]+")
+
 
 def make_file_name_safe(input_basename, replace_str=""):
     """Remove non-safe characters from a filename and return a filename with
@@ -18,14 +21,13 @@ def make_file_name_safe(input_basename, replace_str=""):
     :rtype: str
     """
 
-    safe_patt = re.compile(r"[^A-Za-z0-9_\-.]+")
     # if the replacement is not a string or not safe, set replace_str to x
-    if not isinstance(replace_str, str) or safe_patt.match(replace_str):
+    if not isinstance(replace_str, str) or SAFE_PATTERN.match(replace_str):
         log.warning("{} is not a safe string, removing instead".format(replace_str))
         replace_str = ""
 
     # Replace non-alphanumeric (or underscore) characters with replace_str
-    safe_output_basename = re.sub(safe_patt, replace_str, input_basename)
+    safe_output_basename = SAFE_PATTERN.sub(replace_str, input_basename)
 
     if safe_output_basename.startswith("."):
         safe_output_basename = safe_output_basename[1:]
@@ -0,0 +1,52 @@
+"""Ask the kernel to start reading files before they are needed."""
+
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+
+def prefetch(paths):
+    """Start reading files into the page cache in a background thread.
+
+    The thread only advises the kernel (posix_fadvise WILLNEED) so it returns
+    quickly and nothing needs to wait for it.  Files that cannot be opened are
+    skipped.
+
+    Args:
+        paths (list of str or Path): files that will be read soon
+
+    Returns:
+        thread (threading.Thread): the daemon thread giving the advice or None if
+            the platform does not support it
+    """
+
+    if not hasattr(os, "posix_fadvise"):
+        return None
+
+    thread = threading.Thread(target=will_need, args=(list(paths),), daemon=True)
+    thread.start()
+
+    return thread
+
+
+def will_need(paths):
+    """Tell the kernel that the given files will be read soon.
+
+    Args:
+        paths (list of str or Path): files that will be read soon
+    """
+
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError as exc:
+            log.debug("Not prefetching %s: %s", path, exc)
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError as exc:
+            log.debug("Not prefetching %s: %s", path, exc)
+        finally:
+            os.close(fd)
@@ -0,0 +1,90 @@
+"""Zip a directory quickly, without compressing what is already compressed."""
+
+import logging
+import os
+import zipfile
+
+from utils.fly.prefetch import prefetch
+
+log = logging.getLogger(__name__)
+
+# Deflating these again takes a lot of time and saves almost no space
+# (.m3z morphs such as mri/transforms/talairach.m3z are gzipped too)
+COMPRESSED_EXTENSIONS = (".mgz", ".gz", ".m3z", ".zip")
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Deflate at the fastest level
+COMPRESS_LEVEL = 1
+
+
+def zip_output(
+    root_dir, source_dir, output_zip_filename, dry_run=False, exclude_files=None
+):
+    """Zip <root_dir>/<source_dir> into <root_dir>/<output_zip_filename>.
+
+    This is a drop-in replacement for the gear toolkit's zip_output().  Files
+    that are already compressed are stored as they are and everything else is
+    deflated at the fastest level.  Files are streamed into the zip file with
+    the public zipfile API while the kernel reads ahead.  The current directory
+    is not changed so this can be run in a thread.
+
+    Args:
+        root_dir (str): paths in the zip file are relative to this directory
+        source_dir (str): subdirectory (of <root_dir>) to zip
+        output_zip_filename (str): name of the zip file to create in root_dir
+            (or an absolute path to create it elsewhere)
+        dry_run (boolean): actually do it or do everything but
+        exclude_files (list of str): paths (relative to root_dir) to leave out
+    """
+
+    if not os.path.exists(root_dir):
+        raise FileNotFoundError(f"The directory, {root_dir}, does not exist.")
+
+    log.info("Zipping output file %s", output_zip_filename)
+    if dry_run:
+        return
+
+    exclude = set(exclude_files) if exclude_files else set()
+
+    zip_path = os.path.join(root_dir, output_zip_filename)
+    if os.path.exists(zip_path):
+        os.remove(zip_path)
+
+    entries = []
+    for root, subdirs, files in os.walk(os.path.join(root_dir, source_dir)):
+        for name in files + subdirs:
+            path = os.path.join(root, name)
+            arcname = os.path.relpath(path, root_dir)
+            if arcname not in exclude:
+                entries.append((path, arcname))
+
+    # Have the kernel read ahead while files are being compressed
+    prefetch([path for path, _ in entries])
+
+    # Write in large blocks rather than the default 8 KiB
+    with open(zip_path, "wb", buffering=COPY_BUFFER_SIZE) as raw, zipfile.ZipFile(
+        raw, "w", zipfile.ZIP_DEFLATED, allowZip64=True, compresslevel=COMPRESS_LEVEL
+    ) as outzip:
+        for path, arcname in entries:
+            write_file(outzip, path, arcname)
+
+
+def write_file(outzip, path, arcname):
+    """Add a file (or directory) to an open zip file.
+
+    Args:
+        outzip (zipfile.ZipFile): zip file opened for writing
+        path (str): the file to add
+        arcname (str): the name of the file in the zip archive
+    """
+
+    if path.endswith(COMPRESSED_EXTENSIONS):
+        outzip.write(path, arcname, compress_type=zipfile.ZIP_STORED)
+    else:
+        outzip.write(
+            path,
+            arcname,
+            compress_type=zipfile.ZIP_DEFLATED,
+            compresslevel=COMPRESS_LEVEL,
+        )